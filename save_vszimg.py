@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
-from veusz.plugins import ToolsPlugin, toolspluginregistry, FieldInt, FieldCombo
-from array import array
+from veusz.plugins import ToolsPlugin, toolspluginregistry, FieldInt, FieldCombo, FieldText, FieldBool
+from concurrent.futures import ThreadPoolExecutor
 import veusz.qtall as qt
-import xml.etree.ElementTree as ET
-import io, os, tempfile, struct, warnings, zlib
+import math, os, re, sys, tempfile
+
+# vszimg_backends.py is placed next to this plugin file
+try:
+    _plugindir = os.path.dirname(os.path.abspath(__file__))
+except NameError:
+    _plugindir = os.getcwd()
+if _plugindir not in sys.path:
+    sys.path.insert(0, _plugindir)
+from vszimg_backends import backendregistry, backend_by_name, PNGBackend, SVGBackend
+from vszimg_canon import canonicalize_script
+from vszimg_store import store_script
 
 
 class SaveVSZImagePlugin(ToolsPlugin):
@@ -11,18 +21,22 @@ class SaveVSZImagePlugin(ToolsPlugin):
     menu = ('Save Veusz-image',)
     name = 'Save Veusz-image'
     description_short = 'Save Veusz-image.'
-    description_full = 'Press "Apply" to select image (PNG or SVG).'
+    description_full = 'Press "Apply" to select image (PNG, SVG, SVGZ, PDF or WebP).'
+    probe_dpi = 30
     
     def __init__(self):
         """
-        file_format: .png or .svg
+        file_format: one of the registered image containers
         page_number: page-number to be exported as image
+        resolutions: DPI or pixel-width targets of raster images, e.g. "72, 150dpi, 320px"
+        canonical: embed the canonical form of the script
+        store: directory or SQLite file where scripts are shared by reference
         """
         self.fields = [
             FieldCombo(
                 name="format",
                 descr="Image file format",
-                items=("PNG", "SVG"), 
+                items=tuple(backend.name for backend in backendregistry),
                 default="PNG"
                 ),
             FieldInt(
@@ -30,6 +44,21 @@ class SaveVSZImagePlugin(ToolsPlugin):
                 descr="Page number for image",
                 default=1
                 ),
+            FieldText(
+                name="resolutions",
+                descr="Resolutions for PNG/WebP (e.g. 72, 600dpi, 320px)",
+                default=""
+                ),
+            FieldBool(
+                name="canonical",
+                descr="Canonicalize script before embedding",
+                default=False
+                ),
+            FieldText(
+                name="store",
+                descr="Script store (directory or .sqlite file, blank to embed)",
+                default=""
+                ),
             ]
                     
     def apply(self, interface, fields):
@@ -50,162 +79,112 @@ class SaveVSZImagePlugin(ToolsPlugin):
         tmpdir.cleanup()
         # Export image and embed script
         page = fields['pagenum'] - 1
-        imgtype = fields['format']
+        backend = backend_by_name(fields['format'])
+        patterns = [f'*{ext} *{ext.upper()}' for ext in backend.extensions]
+        type_filter = "Images (%s)" % ' '.join(patterns)
         get_filepath = qt.QFileDialog.getSaveFileName
-        if imgtype == "SVG":
-            type_filter = "Images (*.svg *.SVG)"
-            (filepath, fltr) = get_filepath(caption='Save', filter=type_filter)
-            if filepath:
-                if filepath[-4:] not in (".svg", ".SVG"):
-                    filepath += ".svg"
-                interface.Export(filepath, page=page)
-                self.embed_script_to_svg(filepath, script)
-        else:
-            type_filter = "Images (*.png *.PNG)"
-            (filepath, fltr) = get_filepath(caption='Save', filter=type_filter)
-            if filepath: 
-                if filepath[-4:] not in (".png", ".PNG"):
-                    filepath += ".png" 
-                interface.Export(filepath, page=page)
-                self.embed_script_to_png(filepath, script)
+        (filepath, fltr) = get_filepath(caption='Save', filter=type_filter)
+        if filepath:
+            if not filepath.lower().endswith(backend.extensions):
+                filepath += backend.extensions[0]
+            if fields['canonical']:
+                script = canonicalize_script(
+                    script, importpath=os.path.dirname(os.path.abspath(filepath)))
+            if fields['store'].strip():
+                script = store_script(script, fields['store'].strip(), filepath)
+            resolutions = fields['resolutions'].strip()
+            if resolutions and backend.raster:
+                self.export_resolutions(
+                    interface, filepath, page, backend, script, resolutions)
+            else:
+                backend.export(interface, filepath, page)
+                backend.embed(filepath, script)
+
+    def parse_resolutions(self, resolutions):
+        """
+        Parse "72, 600dpi, 320px" into [(72, 'dpi'), (600, 'dpi'), (320, 'px')].
+        Repeated targets such as "72, 72dpi" are kept once, since they
+        would be saved to the same file.
+        """
+        targets = []
+        for item in resolutions.replace(';', ',').split(','):
+            match = re.fullmatch(r'\s*(\d+)\s*(dpi|px)?\s*', item, re.IGNORECASE)
+            if not match or int(match.group(1)) <= 0:
+                raise Exception("Invalid resolution: %s" % item.strip())
+            target = (int(match.group(1)), (match.group(2) or 'dpi').lower())
+            if target not in targets:
+                targets.append(target)
+        return targets
+
+    def export_resolutions(self, interface, filepath, page, backend, script, resolutions):
+        """
+        Render the page once at the highest resolution any target needs,
+        then save a downsampled variant for each target as
+        <name>_<target><ext> on a worker pool.
+        Qt's smooth scaling averages the covered source area when shrinking.
+        The PNG script chunk is compressed once and shared by all variants.
+        """
+        targets = self.parse_resolutions(resolutions)
+        dpis = [value for (value, unit) in targets if unit == 'dpi']
+        widths = [value for (value, unit) in targets if unit == 'px']
+        tmpdir = tempfile.TemporaryDirectory()
+        try:
+            rendered = os.path.join(tmpdir.name, 'render.png')
+            renderdpi = max(dpis, default=0)
+            if widths:
+                # Page width from a cheap low-resolution render
+                interface.Export(rendered, page=page, dpi=self.probe_dpi)
+                probe = qt.QImage(rendered)
+                if probe.isNull():
+                    raise Exception("Failed to render page %d" % (page + 1))
+                # The probe may be up to one pixel wider than the page
+                inches = max(probe.width() - 1, 1) / self.probe_dpi
+                renderdpi = max(renderdpi, math.ceil(max(widths) / inches))
+            interface.Export(rendered, page=page, dpi=renderdpi)
+            image = qt.QImage(rendered)
+        finally:
+            tmpdir.cleanup()
+        if image.isNull():
+            raise Exception("Failed to render page %d" % (page + 1))
+        if backend.name == 'PNG':
+            backend = PNGBackend(compress=True)
+            backend.script_chunk(script)
+        (stem, ext) = os.path.splitext(filepath)
+        imgformat = backend.extensions[0][1:].upper()
+        quality = backend.export_options.get('quality', -1)
+
+        def save_variant(target):
+            (value, unit) = target
+            if unit == 'dpi':
+                scale = value / renderdpi
+            else:
+                scale = value / image.width()
+            if scale == 1:
+                variant = image
+            else:
+                variant = image.scaled(
+                    max(1, round(image.width() * scale)),
+                    max(1, round(image.height() * scale)),
+                    qt.Qt.AspectRatioMode.IgnoreAspectRatio,
+                    qt.Qt.TransformationMode.SmoothTransformation)
+            variantpath = f'{stem}_{value}{unit}{ext}'
+            if not variant.save(variantpath, imgformat, quality):
+                raise Exception("Failed to write %s" % variantpath)
+            backend.embed(variantpath, script)
+
+        with ThreadPoolExecutor() as pool:
+            list(pool.map(save_variant, targets))
     
     def embed_script_to_png(self, filepath, script):
         """
         The script data will be saved in tEXt chunk in the PNG file
-        modified code from https://stackoverflow.com/a/51058689
         """
-        def write_chunk(outfile, tag, data=b''):
-            data = bytes(data)
-            outfile.write(struct.pack("!I", len(data)))
-            outfile.write(tag)
-            outfile.write(data)
-            checksum = zlib.crc32(tag)
-            checksum = zlib.crc32(data, checksum)
-            checksum &= 2 ** 32 - 1
-            outfile.write(struct.pack("!I", checksum))
-
-        def write_chunks(out, chunks):
-            signature = struct.pack('8B', 137, 80, 78, 71, 13, 10, 26, 10)
-            out.write(signature)
-            for chunk in chunks:
-                write_chunk(out, *chunk)
-        
-        reader = PNGReader(filename=filepath)
-        chunks = reader.chunks()
-        chunk_list = list(chunks)
-        chunk_item = tuple([b'tEXt', bytes(script, 'utf-8')])
-        chunk_list.insert(1, chunk_item)
-        with open(filepath, 'wb') as f:
-            write_chunks(f, chunk_list)
+        PNGBackend().embed(filepath, script)
 
     def embed_script_to_svg(self, filepath, script):
         """
         The script data will be saved in <metadata> element in the SVG file
         """
-        namespace = r'{https://veusz.github.io/}'
-        tree = ET.parse(filepath)
-        root = tree.getroot()
-        metadata = ET.SubElement(root, 'metadata')
-        vszdata = ET.SubElement(metadata, f'{namespace}veusz')
-        vszdata.set("script", script)
-        tree.write(filepath, encoding="UTF-8")
-
-
-class PNGReader:
-    """
-    This is a subclass extracted from the library pypng (https://github.com/drj11/pypng)
-    with removal of some unused functions.
-    """
-    def __init__(self, _guess=None, filename=None, file=None, bytes=None):
-        keywords_supplied = (
-            (_guess is not None) +
-            (filename is not None) +
-            (file is not None) +
-            (bytes is not None))
-        if keywords_supplied != 1:
-            raise TypeError("PNGReader() takes exactly 1 argument")
-        self.signature = None
-        self.transparent = None
-        self.atchunk = None
-        if _guess is not None:
-            if isinstance(_guess, array):
-                bytes = _guess
-            elif isinstance(_guess, str):
-                filename = _guess
-            elif hasattr(_guess, 'read'):
-                file = _guess
-        if bytes is not None:
-            self.file = io.BytesIO(bytes)
-        elif filename is not None:
-            self.file = open(filename, "rb")
-        elif file is not None:
-            self.file = file
-        else:
-            raise Exception("expecting filename, file or bytes array")
-
-    def chunk(self, lenient=False):
-        self.validate_signature()
-        if not self.atchunk:
-            self.atchunk = self._chunk_len_type()
-        if not self.atchunk:
-            raise Exception("No more chunks.")
-        length, type = self.atchunk
-        self.atchunk = None
-
-        data = self.file.read(length)
-        if len(data) != length:
-            raise Exception(
-                'Chunk %s too short for required %i octets.'
-                % (type, length))
-        checksum = self.file.read(4)
-        if len(checksum) != 4:
-            raise Exception('Chunk %s too short for checksum.' % type)
-        verify = zlib.crc32(type)
-        verify = zlib.crc32(data, verify)
-        verify &= 2**32 - 1
-        verify = struct.pack('!I', verify)
-        if checksum != verify:
-            (a, ) = struct.unpack('!I', checksum)
-            (b, ) = struct.unpack('!I', verify)
-            message = ("Checksum error in %s chunk: 0x%08X != 0x%08X."
-                    % (type.decode('ascii'), a, b))
-            if lenient:
-                warnings.warn(message, RuntimeWarning)
-            else:
-                raise Exception(message)
-        return type, data
-
-    def chunks(self):
-        while True:
-            t, v = self.chunk()
-            yield t, v
-            if t == b'IEND':
-                break
-
-    def validate_signature(self):
-        signature = struct.pack('8B', 137, 80, 78, 71, 13, 10, 26, 10)
-        if self.signature:
-            return
-        self.signature = self.file.read(8)
-        if self.signature != signature:
-            raise Exception("PNG file has invalid signature.")
-
-    def _chunk_len_type(self):
-        x = self.file.read(8)
-        if not x:
-            return None
-        if len(x) != 8:
-            raise Exception(
-                'End of file whilst reading chunk length and type.')
-        length, type = struct.unpack('!I4s', x)
-        if length > 2 ** 31 - 1:
-            raise Exception('Chunk %s is too large: %d.' % (type, length))
-        type_bytes = set(bytearray(type))
-        if not(type_bytes <= set(range(65, 91)) | set(range(97, 123))):
-            raise Exception(
-                'Chunk %r has invalid Chunk Type.'
-                % list(type))
-        return length, type
-
+        SVGBackend().embed(filepath, script)
 
 toolspluginregistry.append(SaveVSZImagePlugin)
\ No newline at end of file
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the script canonicalization.
+
+    python test/check_canon.py
+
+The script of test.png and a few small scripts are canonicalized. Each
+canonical script must build the same document as the original through the
+stub interface, apart from a temporary AddImportPath(), be its own
+canonical form, and only change widgets after they have been added. The exit status is 1 if any check fails.
+"""
+import os, sys, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vszimg_backends import PNGBackend
+from vszimg_canon import canonicalize_script, normalize_import_paths, replay
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULTS = {'graph': {'leftMargin': '1.7cm'}}
+
+VERBOSE = """# Veusz saved document (version 3.3.1)
+# Saved at 2021-08-12T15:54:48.807358
+
+SetData('y', [1.0, 2.50, 3e0])
+Add('page', name='page1', autoadd=False)
+To('page1')
+Add('graph', name='graph1', autoadd=False)
+To('graph1')
+Set('leftMargin', '1.7cm')
+Set('rightMargin', '0.1cm')
+Set('rightMargin', '0.2cm')
+To('..')
+To('/page1/graph1')
+Add('xy', name='xy1')
+To('xy1')
+Set('yData', u'y')
+Set('markerSize', 3.00)
+To('../..')
+To('..')
+"""
+
+QUALIFIED = """# Veusz saved document
+Add('page', name='page1')
+To('page1')
+Add('graph', name='graph1')
+To('..')
+Set('page1/graph1/leftMargin', '1cm')
+Set('/page1/graph1/Border/color', 'red')
+"""
+
+UNSUPPORTED = """# Veusz saved document
+for name in ('page1', 'page2'):
+    Add('page', name=name)
+"""
+
+
+def check_script(name, script, results):
+    canonical = canonicalize_script(script, DEFAULTS)
+    results.append(('%s: changed' % name, canonical != script))
+    # The temporary AddImportPath() is dropped on purpose
+    original = replay(normalize_import_paths(script))
+    results.append(('%s: same document' % name,
+                    replay(canonical).state(DEFAULTS) == original.state(DEFAULTS)))
+    results.append(('%s: idempotent' % name,
+                    canonicalize_script(canonical, DEFAULTS) == canonical))
+    return canonical
+
+
+def main(argv=None):
+    results = []
+    script = PNGBackend().read_script(os.path.join(TESTDIR, 'test.png'))
+    check_script('test.png', script, results)
+
+    canonical = check_script('verbose', VERBOSE, results)
+    results.append(('verbose: defaults and comments dropped',
+                    "'1.7cm'" not in canonical and '# Saved at' not in canonical
+                    and "'0.1cm'" not in canonical))
+    results.append(('verbose: numbers written with repr()',
+                    '[1.0, 2.5, 3.0]' in canonical
+                    and "Set('markerSize', 3.0)" in canonical))
+
+    canonical = check_script('qualified', QUALIFIED, results)
+    lines = canonical.splitlines()
+    results.append(('qualified: settings written inside the widget',
+                    "Set('leftMargin', '1cm')" in lines
+                    and "Set('Border/color', 'red')" in lines
+                    and lines.index("Set('leftMargin', '1cm')")
+                    > lines.index("To('graph1')")))
+
+    importpaths = []
+    for i in range(2):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            saved = script.replace(
+                script.split('AddImportPath(', 1)[1].split(')', 1)[0], repr(tmpdir))
+            importpaths.append(canonicalize_script(saved, importpath='/figs'))
+    results.append(('temporary AddImportPath replaced',
+                    importpaths[0] == importpaths[1]
+                    and "AddImportPath('/figs')" in importpaths[0]))
+
+    results.append(('unsupported script kept',
+                    canonicalize_script(UNSUPPORTED) == UNSUPPORTED))
+
+    failures = [name for name, ok in results if not ok]
+    for name, ok in results:
+        print('%-50s %s' % (name, 'ok' if ok else 'FAILED'))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Round-trip checks of the PDF, WebP and SVG backends.
+
+    python test/check_containers.py
+
+A minimal classic-xref PDF, whose title holds parentheses and the word
+"stream", lossless and lossy WebP files with and without foreign XMP, and
+SVG files with short and long prologs are built, and a script is embedded,
+replaced, extracted and stripped again. The exit status is 1 if any check
+fails.
+"""
+import gzip, io, os, struct, sys, tempfile, zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vszimg_backends import (
+    SNIFF_SIZE, PDFBackend, SVGBackend, SVGZBackend, WebPBackend,
+    detect_backend, find_backend)
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = "# Veusz saved document\nAdd('page', name='page1')\n"
+OTHER = "# Veusz saved document\nAdd('page', name='page2')\n"
+FOREIGN_XMP = (b'<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+               b'<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+               b'<rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/">'
+               b'<dc:title>foreign</dc:title></rdf:Description></rdf:RDF></x:xmpmeta>')
+
+
+def minimal_pdf(title):
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>',
+               b'<< /Type /Pages /Kids [] /Count 0 >>',
+               b'<< /Title %s /Producer (check) >>' % title]
+    out = io.BytesIO()
+    out.write(b'%PDF-1.4\n')
+    offsets = []
+    for num, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(b'%d 0 obj\n%s\nendobj\n' % (num, body))
+    xref = out.tell()
+    out.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b'%010d 00000 n \n' % offset)
+    out.write(b'trailer\n<< /Size %d /Root 1 0 R /Info 3 0 R >>\n' % (len(objects) + 1))
+    out.write(b'startxref\n%d\n%%%%EOF\n' % xref)
+    return out.getvalue()
+
+
+def foreign_update(data):
+    """Append an update of the catalog, as a PDF editor would."""
+    backend = PDFBackend()
+    src = io.BytesIO(data)
+    prev = backend.startxref(src)
+    info = backend.find_ref(backend.trailer(src), b'Info')
+    size = int(backend.trailer(src).split(b'/Size')[1].split()[0])
+    offset = len(data) + 1
+    update = b'\n1 0 obj\n<< /Type /Catalog /Pages 2 0 R /PageMode /UseNone >>\nendobj\n'
+    xref = len(data) + len(update)
+    update += b'xref\n1 1\n%010d 00000 n \n' % offset
+    update += (b'trailer\n<< /Size %d /Root 1 0 R /Info %d 0 R /Prev %d >>\n'
+               % (size, info, prev))
+    update += b'startxref\n%d\n%%%%EOF\n' % xref
+    return data + update
+
+
+def embed_bytes(backend, data, script):
+    out = io.BytesIO()
+    backend.embed_stream(io.BytesIO(data), out, script)
+    return out.getvalue()
+
+
+def check_pdf(title, results):
+    backend = PDFBackend()
+    name = 'PDF %s' % title.decode()
+    original = minimal_pdf(title)
+    first = embed_bytes(backend, original, SCRIPT)
+    results.append(('%s: extract' % name,
+                    backend.extract(io.BytesIO(first)) == SCRIPT))
+    results.append(('%s: title kept' % name, b'/Title %s' % title in first[len(original):]))
+    second = embed_bytes(backend, first, OTHER)
+    results.append(('%s: replace' % name,
+                    backend.extract(io.BytesIO(second)) == OTHER
+                    and zlib.compress(bytes(SCRIPT, 'utf-8'), 9) not in second
+                    and second == embed_bytes(backend, original, OTHER)))
+    stripped = embed_bytes(backend, second, None)
+    results.append(('%s: strip' % name,
+                    backend.extract(io.BytesIO(stripped)) == '' and stripped == original))
+    edited = foreign_update(second)
+    results.append(('%s: extract after a later update' % name,
+                    backend.extract(io.BytesIO(edited)) == OTHER))
+    try:
+        embed_bytes(backend, edited, None)
+        refused = False
+    except Exception:
+        refused = True
+    results.append(('%s: strip refused after a later update' % name, refused))
+    third = embed_bytes(backend, edited, SCRIPT)
+    results.append(('%s: replace after a later update' % name,
+                    backend.extract(io.BytesIO(third)) == SCRIPT))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'fig.pdf')
+        with open(path, 'wb') as f:
+            f.write(original)
+        backend.embed(path, SCRIPT)
+        backend.embed(path, OTHER)
+        embedded = backend.read_script(path)
+        backend.strip(path)
+        with open(path, 'rb') as f:
+            results.append(('%s: embed and strip files' % name,
+                            embedded == OTHER and f.read() == original))
+
+
+def riff(chunks):
+    body = b'WEBP'
+    for fourcc, data in chunks:
+        body += struct.pack('<4sI', fourcc, len(data)) + data + b'\0' * (len(data) & 1)
+    return b'RIFF' + struct.pack('<I', len(body)) + body
+
+
+def webp_chunks(data):
+    backend = WebPBackend()
+    src = io.BytesIO(data)
+    chunks = []
+    for fourcc, size in backend.chunks(src):
+        chunks.append((fourcc, src.read(size)))
+        src.read(size & 1)
+    return chunks
+
+
+def vp8l_chunk(width, height, alpha):
+    bits = (width - 1) | (height - 1) << 14 | alpha << 28
+    return (b'VP8L', b'\x2f' + struct.pack('<I', bits) + b'\x00\x01')
+
+
+def vp8_chunk(width, height):
+    return (b'VP8 ', b'\x50\x02\x00\x9d\x01\x2a' + struct.pack('<HH', width, height)
+            + b'\x00' * 7)
+
+
+def check_webp(name, chunks, results, flags=0, size=None):
+    backend = WebPBackend()
+    original = riff(chunks)
+    image = [chunk for chunk in chunks if chunk[0] in (b'VP8 ', b'VP8L')]
+    embedded = embed_bytes(backend, original, SCRIPT)
+    out = webp_chunks(embedded)
+    vp8x = out[0][1]
+    results.append(('%s: extract' % name,
+                    backend.extract(io.BytesIO(embedded)) == SCRIPT))
+    results.append(('%s: RIFF size' % name,
+                    struct.unpack('<I', embedded[4:8])[0] == len(embedded) - 8))
+    results.append(('%s: VP8X header' % name,
+                    out[0][0] == b'VP8X' and vp8x[0] == flags | WebPBackend.XMP_FLAG
+                    and (size is None or vp8x[4:10] == struct.pack('<I', size[0] - 1)[:3]
+                         + struct.pack('<I', size[1] - 1)[:3])))
+    results.append(('%s: image data kept' % name,
+                    [chunk for chunk in out if chunk[0] in (b'VP8 ', b'VP8L')] == image))
+    replaced = embed_bytes(backend, embedded, OTHER)
+    results.append(('%s: replace' % name,
+                    backend.extract(io.BytesIO(replaced)) == OTHER
+                    and [c[0] for c in webp_chunks(replaced)].count(b'XMP ') == 1))
+    stripped = embed_bytes(backend, replaced, None)
+    out = webp_chunks(stripped)
+    foreign = [data for fourcc, data in out if fourcc == b'XMP ']
+    results.append(('%s: strip' % name,
+                    backend.extract(io.BytesIO(stripped)) == ''
+                    and struct.unpack('<I', stripped[4:8])[0] == len(stripped) - 8
+                    and bool(out[0][1][0] & WebPBackend.XMP_FLAG) == bool(foreign)))
+    return foreign
+
+
+def check_svg(name, backend, data, results):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'fig' + backend.extensions[0])
+        with open(path, 'wb') as f:
+            f.write(data)
+        detected = detect_backend(path)
+        results.append(('%s: detected' % name, type(detected) is type(backend)))
+        backend.embed(path, SCRIPT)
+        embedded = backend.read_script(path)
+        backend.strip(path)
+        results.append(('%s: embed, extract and strip' % name,
+                        embedded == SCRIPT and backend.read_script(path) == ''))
+
+
+def main(argv=None):
+    results = []
+    check_pdf(b'(a (b) stream)', results)
+    check_pdf(b'(x \\) endobj stream)', results)
+
+    check_webp('WebP VP8L', [vp8l_chunk(3, 2, 1)], results,
+               flags=WebPBackend.ALPHA_FLAG, size=(3, 2))
+    check_webp('WebP VP8', [vp8_chunk(5, 4)], results, size=(5, 4))
+    vp8x = (b'VP8X', struct.pack('<B3x', WebPBackend.XMP_FLAG) + b'\x02\0\0\x01\0\0')
+    foreign = check_webp('WebP foreign XMP',
+                         [vp8x, vp8l_chunk(3, 2, 0), (b'XMP ', FOREIGN_XMP)],
+                         results, size=(3, 2))
+    results.append(('WebP foreign XMP: kept after strip',
+                    len(foreign) == 1 and b'<dc:title>foreign</dc:title>' in foreign[0]))
+
+    with open(os.path.join(TESTDIR, 'test.svg'), 'rb') as f:
+        svg = f.read()
+    check_svg('SVG', SVGBackend(), svg, results)
+    prolog = b'<?xml version="1.0"?>\n<!--%s-->\n'
+    for size in (600, 2 * SNIFF_SIZE):
+        data = prolog % (b' ' * size) + svg.split(b'?>', 1)[-1]
+        check_svg('SVG with a %d-byte prolog' % size, SVGBackend(), data, results)
+    results.append(('SVG with a short prolog: sniffed',
+                    find_backend(prolog % (b' ' * 600) + svg.split(b'?>', 1)[-1]) is not None))
+    svgz = io.BytesIO()
+    with gzip.GzipFile(fileobj=svgz, mode='wb') as gz:
+        gz.write(svg)
+    check_svg('SVGZ', SVGZBackend(), svgz.getvalue(), results)
+
+    failures = [name for name, ok in results if not ok]
+    for name, ok in results:
+        print('%-50s %s' % (name, 'ok' if ok else 'FAILED'))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
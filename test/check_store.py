@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the shared script store.
+
+    python test/check_store.py
+
+The script of test.png is saved twice, with a different save time and
+temporary AddImportPath() each time, into a directory store and into an
+SQLite store, and looked up again through the embedded reference, or
+through its inline fallback when the store is missing.
+The exit status is 1 if any check fails.
+"""
+import os, re, sys, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vszimg_backends import PNGBackend
+from vszimg_store import REFERENCE_HEADER, resolve_script, store_script
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def saved_copy(script, timestamp):
+    """Return the script as another save of the document would write it."""
+    tmpdir = tempfile.mkdtemp()
+    os.rmdir(tmpdir)
+    script = re.sub(r'(?m)^# Saved at .*$', '# Saved at ' + timestamp, script)
+    return re.sub(r"(?m)^AddImportPath\(.*\)$", 'AddImportPath(%r)' % tmpdir, script)
+
+
+def check_store(storename, script, results):
+    with tempfile.TemporaryDirectory() as imagedir:
+        storepath = os.path.join(imagedir, storename)
+        imagepath = os.path.join(imagedir, 'fig.png')
+        first = store_script(
+            saved_copy(script, '2021-08-12T15:54:48.807358'), storepath, imagepath)
+        second = store_script(
+            saved_copy(script, '2022-01-01T00:00:00.000000'), storepath, imagepath)
+        results.append(('%s: reference embedded' % storename,
+                        first.startswith(REFERENCE_HEADER)))
+        results.append(('%s: same digest for two saves' % storename, first == second))
+        loaded = resolve_script(first, imagepath)
+        results.append(('%s: lookup returns the script' % storename,
+                        loaded.startswith('# Veusz') and 'ImportString(' in loaded
+                        and '# Saved at' not in loaded))
+        missing = os.path.join(imagedir, 'moved', 'fig.png')
+        results.append(('%s: fallback without the store' % storename,
+                        resolve_script(first, missing) == loaded))
+        bare = re.sub(r'(?m)^# fallback: .*\n', '', first)
+        try:
+            resolve_script(bare.replace(storename, 'missing-' + storename), missing)
+            error = ''
+        except Exception as e:
+            error = str(e)
+        results.append(('%s: readable error for a missing store' % storename,
+                        'not found' in error
+                        and not os.path.exists(os.path.join(imagedir, 'missing-' + storename))))
+
+
+def main(argv=None):
+    script = PNGBackend().read_script(os.path.join(TESTDIR, 'test.png'))
+    results = []
+    check_store('scripts', script, results)
+    check_store('scripts.sqlite', script, results)
+    failures = [name for name, ok in results if not ok]
+    for name, ok in results:
+        print('%-50s %s' % (name, 'ok' if ok else 'FAILED'))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
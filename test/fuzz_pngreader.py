@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Stress and fuzz harness for the PNG chunk reader.
+
+    python test/fuzz_pngreader.py --iterations 500 --seed 1 --max-chunk 1048576
+
+The script is stripped from test.png, so that the reader has to walk every
+chunk, and malformed, truncated and oversized-chunk PNGs are made from it.
+A large valid script and a zTXt bomb larger than the budget are added.
+Each case is extracted with PNGBackend.extract() and copied with
+embed_stream(), which reads and checks every chunk, from a seekable buffer
+and from a pipe-like stream, while time and peak Python memory are measured
+with tracemalloc. The exit status is 1 if a case runs out of memory, takes
+longer than --max-seconds, or its peak exceeds four times the file size and
+1 MiB. Only the large script and the zTXt bomb may also use the chunk
+budget, so that a malformed file which declares a large chunk fails when
+the reader allocates it.
+"""
+import argparse, io, math, os, random, struct, sys, time, tracemalloc, zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vszimg_backends import PNG_SIGNATURE, PNGBackend, PNGReader, write_chunk
+
+MiB = 1024 * 1024
+BUDGET_CASES = ('large_script', 'ztxt_bomb')
+
+
+class PipeStream(io.RawIOBase):
+    """Non-seekable view of bytes, like stdin."""
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self.data) - self.pos)
+        b[:n] = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+def build_png(chunks):
+    out = io.BytesIO()
+    out.write(PNG_SIGNATURE)
+    for tag, data in chunks:
+        write_chunk(out, tag, data)
+    return out.getvalue()
+
+
+def chunk_offsets(data):
+    """Return the offsets of the length fields of the chunks."""
+    offsets, pos = [], 8
+    while pos + 8 <= len(data):
+        offsets.append(pos)
+        (length,) = struct.unpack('!I', data[pos:pos + 4])
+        pos += 12 + length
+    return offsets
+
+
+def case_truncated(rng, base):
+    return base[:rng.randrange(len(base))]
+
+
+def case_flipped(rng, base):
+    data = bytearray(base)
+    for i in range(rng.randint(1, 8)):
+        data[rng.randrange(len(data))] ^= 1 << rng.randrange(8)
+    return bytes(data)
+
+
+def case_oversized(rng, base):
+    """Declare a length beyond the file, log-uniformly up to 2^31 - 1."""
+    data = bytearray(base)
+    pos = rng.choice(chunk_offsets(base))
+    length = rng.choice([len(base), 2 ** 31 - 1,
+                         int(2 ** rng.uniform(math.log2(len(base)), 31))])
+    data[pos:pos + 4] = struct.pack('!I', length)
+    return bytes(data)
+
+
+def case_bad_type(rng, base):
+    data = bytearray(base)
+    pos = rng.choice(chunk_offsets(base))
+    data[pos + 4 + rng.randrange(4)] = rng.choice(b'\0 0@[`{\xff')
+    return bytes(data)
+
+
+def case_large_script(rng, base, size):
+    script = '# Veusz stress\n' + 'Set("x", 1.0)\n' * (size // 14)
+    chunks = list(PNGReader(bytes=base).chunks())
+    chunks.insert(1, (b'tEXt', script.encode()))
+    return build_png(chunks)
+
+
+def case_ztxt_bomb(rng, base, size):
+    data = PNGBackend.ztxt_keyword + b'\0' + zlib.compress(b'# Veusz' + b' ' * size, 9)
+    chunks = list(PNGReader(bytes=base).chunks())
+    chunks.insert(1, (b'zTXt', data))
+    return build_png(chunks)
+
+
+def strip_script(data):
+    backend = PNGBackend()
+    return build_png((tag, chunk) for tag, chunk in PNGReader(bytes=data).chunks()
+                     if not backend.is_script_chunk(tag, chunk))
+
+
+def measure(data, op, stream, max_chunk):
+    """Run the operation on the data and return (outcome, seconds, peak octets)."""
+    src = io.BytesIO(data) if stream == 'file' else io.BufferedReader(PipeStream(data))
+    backend = PNGBackend()
+    backend.max_chunk = max_chunk
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        if op == 'extract':
+            outcome = 'script' if backend.extract(src) else 'empty'
+        else:
+            backend.embed_stream(src, io.BytesIO(), '# Veusz fuzz\n')
+            outcome = 'copied'
+    except (MemoryError, RecursionError) as e:
+        outcome = 'FAIL ' + type(e).__name__
+    except Exception as e:
+        outcome = 'rejected ' + type(e).__name__
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return outcome, elapsed, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--max-chunk', type=int, default=PNGBackend.max_chunk,
+        help='chunk budget of the reader (default: %(default)d, 0 for none)')
+    parser.add_argument('--large-mb', type=int, default=16,
+                        help='size of the large script, and of the zTXt bomb '
+                             'if there is no budget')
+    parser.add_argument('--max-seconds', type=float, default=1.0)
+    parser.add_argument(
+        '--image', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.png'))
+    args = parser.parse_args(argv)
+    max_chunk = args.max_chunk or None
+    bombsize = 2 * max_chunk if max_chunk else args.large_mb * MiB
+
+    rng = random.Random(args.seed)
+    with open(args.image, 'rb') as f:
+        base = strip_script(f.read())
+    kinds = [case_truncated, case_flipped, case_oversized, case_bad_type]
+    cases = [(kind.__name__[5:], kind(rng, base))
+             for i in range(args.iterations) for kind in kinds]
+    cases.append(('large_script', case_large_script(rng, base, args.large_mb * MiB)))
+    cases.append(('ztxt_bomb', case_ztxt_bomb(rng, base, bombsize)))
+
+    stats, failures = {}, []
+    for name, data in cases:
+        limit = 4 * len(data) + MiB
+        if name in BUDGET_CASES:
+            limit += max_chunk or 0
+        for op in ('extract', 'embed'):
+            for stream in ('file', 'pipe'):
+                outcome, elapsed, peak = measure(data, op, stream, max_chunk)
+                key = (name, op, stream)
+                count, outcomes, maxtime, maxpeak = stats.get(key, (0, {}, 0, 0))
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                stats[key] = (count + 1, outcomes, max(maxtime, elapsed),
+                              max(maxpeak, peak))
+                if (outcome.startswith('FAIL') or elapsed > args.max_seconds
+                        or peak > limit):
+                    failures.append('%s/%s/%s: %s, %.3f s, %.1f MiB peak for %.1f MiB'
+                                    % (name, op, stream, outcome, elapsed,
+                                       peak / MiB, len(data) / MiB))
+
+    print('%-14s %-7s %-5s %6s %9s %10s  outcomes'
+          % ('case', 'op', 'input', 'count', 'max ms', 'peak MiB'))
+    for (name, op, stream), (count, outcomes, maxtime, maxpeak) in stats.items():
+        print('%-14s %-7s %-5s %6d %9.2f %10.2f  %s'
+              % (name, op, stream, count, maxtime * 1000, maxpeak / MiB,
+                 ', '.join('%s: %d' % item for item in sorted(outcomes.items()))))
+    for failure in failures:
+        print('FAILED ' + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,901 @@
+# -*- coding: utf-8 -*-
+"""
+Container backends for Veusz-images.
+
+Each backend knows how to recognise its container from the first few bytes
+of a file and how to embed/extract the Veusz script in it. Backends are
+registered in `backendregistry`, in the same way as Veusz plugins.
+This module does not depend on Veusz, so it can also be used outside of it.
+"""
+from array import array
+import xml.etree.ElementTree as ET
+import contextlib, gzip, io, os, re, shutil, struct, tempfile, warnings, zlib
+
+VEUSZ_NAMESPACE = r'{https://veusz.github.io/}'
+PNG_SIGNATURE = struct.pack('8B', 137, 80, 78, 71, 13, 10, 26, 10)
+SNIFF_SIZE = 4096
+COPY_BLOCK = 64 * 1024
+
+backendregistry = []
+
+
+class ImageBackend:
+    """Base class of an image container which can hold a Veusz script."""
+    name = ''
+    extensions = ()
+    export_options = {}
+    streamable = True
+    raster = False
+
+    def sniff(self, head):
+        """Return True if the leading bytes `head` belong to this container."""
+        raise NotImplementedError
+
+    def extract(self, file):
+        """Return the script in the binary file object, or '' if none."""
+        raise NotImplementedError
+
+    def embed_stream(self, src, out, script):
+        """
+        Copy the image from src to the seekable out, replacing any older
+        script with `script`, or just removing it if `script` is None.
+        """
+        raise NotImplementedError
+
+    def embed(self, filepath, script):
+        """Embed the script into the image file, replacing any older one."""
+        with open(filepath, 'rb') as src, rewrite(filepath) as out:
+            self.embed_stream(src, out, script)
+
+    def strip(self, filepath):
+        """Remove the script from the image file."""
+        self.embed(filepath, None)
+
+    def export(self, interface, filepath, page):
+        """Export the page of the current Veusz document to the file."""
+        interface.Export(filepath, page=page, **self.export_options)
+
+    def read_script(self, filepath):
+        with open(filepath, 'rb') as f:
+            return self.extract(f)
+
+
+def find_backend(head):
+    """Return the backend matching the leading bytes, or None."""
+    for backend in backendregistry:
+        if backend().sniff(head):
+            return backend()
+    return None
+
+
+def detect_backend(filepath):
+    """
+    Return the backend for the file, judged from its signature,
+    or from its extension if no signature matches.
+    """
+    with open(filepath, 'rb') as f:
+        head = f.read(SNIFF_SIZE)
+    backend = find_backend(head)
+    if backend is None:
+        backend = backend_for_filename(filepath)
+    return backend
+
+
+def backend_for_filename(filepath):
+    for backend in backendregistry:
+        if filepath.lower().endswith(backend.extensions):
+            return backend()
+    return None
+
+
+def backend_by_name(name):
+    for backend in backendregistry:
+        if backend.name == name:
+            return backend()
+    raise Exception("Unknown image format: %s" % name)
+
+
+def file_filter():
+    """Return a file dialog filter for all the registered containers."""
+    patterns = ['*' + ext for b in backendregistry for ext in b.extensions]
+    return "Images (%s)" % ' '.join(patterns)
+
+
+def get_script(filepath):
+    """Extract the script from an image of any registered container."""
+    backend = detect_backend(filepath)
+    if backend is None:
+        raise Exception("Unsupported image format: %s" % filepath)
+    return backend.read_script(filepath)
+
+
+@contextlib.contextmanager
+def rewrite(filepath):
+    """
+    Yield a temporary file which replaces `filepath` when the block succeeds.
+    """
+    dirname = os.path.dirname(os.path.abspath(filepath))
+    fd, tmppath = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w+b') as out:
+            yield out
+        if os.path.exists(filepath):
+            shutil.copymode(filepath, tmppath)
+        os.replace(tmppath, filepath)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+
+def copy_bytes(src, dst, length):
+    """Copy `length` bytes from src to dst in bounded blocks."""
+    while length > 0:
+        block = src.read(min(length, COPY_BLOCK))
+        if not block:
+            raise Exception('Unexpected end of file.')
+        dst.write(block)
+        length -= len(block)
+
+
+def skip_bytes(file, length):
+    """Move forward `length` bytes, by seeking if the file allows it."""
+    if file.seekable():
+        file.seek(length, 1)
+    else:
+        while length > 0:
+            block = file.read(min(length, COPY_BLOCK))
+            if not block:
+                raise Exception('Unexpected end of file.')
+            length -= len(block)
+
+
+class PNGBackend(ImageBackend):
+    """
+    Script is saved in a tEXt chunk starting with "# Veusz",
+    or with `compress` in a zTXt chunk with the keyword "Veusz".
+    `max_chunk` limits the octets read or decompressed for one chunk,
+    so that untrusted images cannot make the reader allocate gigabytes.
+    """
+    name = 'PNG'
+    extensions = ('.png',)
+    raster = True
+    ztxt_keyword = b'Veusz\0'
+    max_chunk = 64 * 1024 * 1024
+
+    def __init__(self, compress=False):
+        self.compress = compress
+        self.chunk_cache = (None, None)
+
+    def sniff(self, head):
+        return head[:8] == PNG_SIGNATURE
+
+    def is_script_chunk(self, tag, data):
+        return ((tag == b'tEXt' and data[:7] == b'# Veusz') or
+                (tag == b'zTXt' and data.startswith(self.ztxt_keyword)))
+
+    def script_chunk(self, script):
+        """
+        Return the serialized chunk holding the script. The last chunk is
+        cached, so embedding one script into many files builds it once.
+        """
+        if self.chunk_cache[0] == script:
+            return self.chunk_cache[1]
+        if self.compress:
+            tag = b'zTXt'
+            data = self.ztxt_keyword + b'\0' + zlib.compress(bytes(script, 'utf-8'), 9)
+        else:
+            tag, data = b'tEXt', bytes(script, 'utf-8')
+        buf = io.BytesIO()
+        write_chunk(buf, tag, data)
+        self.chunk_cache = (script, buf.getvalue())
+        return self.chunk_cache[1]
+
+    def extract(self, file):
+        """
+        Walk the chunk headers and return the first script chunk,
+        skipping the data of every other chunk.
+        """
+        reader = PNGReader(file=file, max_chunk=self.max_chunk)
+        while True:
+            tag = reader.next_type()
+            if tag == b'IEND':
+                return ''
+            if tag not in (b'tEXt', b'zTXt'):
+                reader.skip()
+                continue
+            tag, data = reader.chunk()
+            if not self.is_script_chunk(tag, data):
+                continue
+            if tag == b'zTXt':
+                data = self.inflate(data[len(self.ztxt_keyword) + 1:])
+            return data.decode(errors="ignore")
+
+    def inflate(self, data):
+        """
+        Decompress a zTXt script block by block, so that a compression
+        bomb is refused after `max_chunk` octets without allocating more.
+        """
+        inflate = zlib.decompressobj()
+        pieces, size = [], 0
+        while True:
+            piece = inflate.decompress(data, COPY_BLOCK)
+            data = inflate.unconsumed_tail
+            if not piece and not data:
+                piece = inflate.flush()
+            size += len(piece)
+            if self.max_chunk is not None and size > self.max_chunk:
+                raise Exception(
+                    'Compressed script exceeds the budget of %d octets.'
+                    % self.max_chunk)
+            if not piece:
+                return b''.join(pieces)
+            pieces.append(piece)
+
+    def embed_stream(self, src, out, script):
+        """
+        Copy the file chunk by chunk, inserting the script after IHDR
+        modified code from https://stackoverflow.com/a/51058689
+        """
+        out.write(PNG_SIGNATURE)
+        for tag, data in PNGReader(file=src, max_chunk=self.max_chunk).chunks():
+            if self.is_script_chunk(tag, data):
+                continue
+            write_chunk(out, tag, data)
+            if tag == b'IHDR' and script is not None:
+                out.write(self.script_chunk(script))
+
+
+def write_chunk(outfile, tag, data=b''):
+    data = bytes(data)
+    outfile.write(struct.pack("!I", len(data)))
+    outfile.write(tag)
+    outfile.write(data)
+    checksum = zlib.crc32(tag)
+    checksum = zlib.crc32(data, checksum)
+    checksum &= 2 ** 32 - 1
+    outfile.write(struct.pack("!I", checksum))
+
+
+class SVGBackend(ImageBackend):
+    """Script is saved in the <metadata> element of the SVG file."""
+    name = 'SVG'
+    extensions = ('.svg',)
+    svg_tag = re.compile(rb'<([\w.-]+:)?svg[\s>]')
+
+    def sniff(self, head):
+        head = head.lstrip(b'\xef\xbb\xbf \t\r\n')
+        return head[:1] == b'<' and self.svg_tag.search(head) is not None
+
+    def extract(self, file):
+        for event, elem in ET.iterparse(file, events=('end',)):
+            if elem.tag == f'{VEUSZ_NAMESPACE}veusz':
+                return elem.get('script') or ''
+            elem.clear()
+        return ''
+
+    def embed_stream(self, src, out, script):
+        self.write_tree(ET.parse(src), script, out)
+
+    def write_tree(self, tree, script, out):
+        root = tree.getroot()
+        for metadata in root.findall('./metadata'):
+            if metadata.find(f'./{VEUSZ_NAMESPACE}veusz') is not None:
+                root.remove(metadata)
+        if script is None:
+            tree.write(out, encoding="UTF-8")
+            return
+        metadata = ET.SubElement(root, 'metadata')
+        vszdata = ET.SubElement(metadata, f'{VEUSZ_NAMESPACE}veusz')
+        vszdata.set("script", script)
+        tree.write(out, encoding="UTF-8")
+
+
+class SVGZBackend(SVGBackend):
+    """Gzip-compressed SVG."""
+    name = 'SVGZ'
+    extensions = ('.svgz',)
+
+    def sniff(self, head):
+        if head[:2] != b'\x1f\x8b':
+            return False
+        try:
+            head = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head)
+        except zlib.error:
+            return False
+        return SVGBackend.sniff(self, head)
+
+    def extract(self, file):
+        with gzip.GzipFile(fileobj=file, mode='rb') as gz:
+            return SVGBackend.extract(self, gz)
+
+    def embed_stream(self, src, out, script):
+        with gzip.GzipFile(fileobj=src, mode='rb') as gz:
+            tree = ET.parse(gz)
+        with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as gz:
+            self.write_tree(tree, script, gz)
+
+    def export(self, interface, filepath, page):
+        """Veusz cannot write SVGZ directly, so compress an SVG export."""
+        tmpsvg = filepath + '.svg'
+        interface.Export(tmpsvg, page=page)
+        try:
+            with open(tmpsvg, 'rb') as src, rewrite(filepath) as out:
+                with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as gz:
+                    shutil.copyfileobj(src, gz, COPY_BLOCK)
+        finally:
+            os.remove(tmpsvg)
+
+
+class PDFBackend(ImageBackend):
+    """
+    Script is saved in a compressed stream referenced from the /VeuszScript
+    entry of the document information dictionary. It is appended as an
+    incremental update, so the content of the PDF is never rewritten. An
+    update written here is dropped again when the script is replaced or
+    removed, so older scripts do not pile up in the file.
+    """
+    name = 'PDF'
+    extensions = ('.pdf',)
+    tail_size = 1024
+    ref_pattern = rb'/%s\s+(\d+)\s+(\d+)\s+R'
+    update_marker = b'\n%VeuszScript update\n'
+    streamable = False
+
+    def sniff(self, head):
+        return head[:5] == b'%PDF-'
+
+    def extract(self, file):
+        trailer = self.trailer(file)
+        info = self.find_ref(trailer, b'Info')
+        if info is None:
+            return ''
+        body = self.read_object(file, self.object_offset(file, info))
+        ref = self.find_ref(body, b'VeuszScript')
+        if ref is None:
+            return ''
+        data = self.read_stream(file, self.object_offset(file, ref))
+        return zlib.decompress(data).decode(errors="ignore")
+
+    def embed_stream(self, src, out, script):
+        """Copy the PDF without an update written here, and append a new one."""
+        end = self.update_start(src)
+        if end is None:
+            src.seek(0, 2)
+            end = src.tell()
+        src.seek(0)
+        copy_bytes(src, out, end)
+        self.append_script(out, script)
+
+    def update_start(self, file):
+        """
+        Return the offset where the newest incremental update starts if it
+        was written by append_script, or None.
+        """
+        file.seek(self.startxref(file))
+        if file.readline().strip() != b'xref':
+            return None
+        offsets = []
+        while True:
+            line = file.readline().strip()
+            if not line or line.startswith(b'trailer'):
+                break
+            start, count = (int(x) for x in line.split())
+            for i in range(count):
+                entry = file.read(20).split()
+                if entry[2:] == [b'n']:
+                    offsets.append(int(entry[0]))
+        start = min(offsets, default=0) - len(self.update_marker)
+        if start < 0:
+            return None
+        file.seek(start)
+        if file.read(len(self.update_marker)) != self.update_marker:
+            return None
+        return start
+
+    def append_script(self, f, script):
+        """
+        Append an incremental update to the readable and writable file f,
+        with a new information dictionary pointing to the script.
+        """
+        prev = self.startxref(f)
+        trailer = self.trailer(f)
+        entries = b''
+        info = self.find_ref(trailer, b'Info')
+        if info is not None:
+            entries = self.read_object(f, self.object_offset(f, info))
+            if script is None:
+                if self.find_ref(entries, b'VeuszScript') is None:
+                    return
+                raise Exception(
+                    "The script is followed by later updates of the PDF, "
+                    "so it cannot be removed.")
+            entries = entries.strip()[2:-2]
+            entries = re.sub(self.ref_pattern % b'VeuszScript', b'', entries)
+        elif script is None:
+            return
+        size = int(re.search(rb'/Size\s+(\d+)', trailer).group(1))
+        root = re.search(self.ref_pattern % b'Root', trailer).group(0)
+        fileid = re.search(rb'/ID\s*\[[^\]]*\]', trailer)
+
+        f.seek(0, 2)
+        f.write(self.update_marker)
+        offsets = []
+        if script is not None:
+            data = zlib.compress(bytes(script, 'utf-8'), 9)
+            offsets.append(f.tell())
+            f.write(b'%d 0 obj\n<< /Filter /FlateDecode /Length %d >>\nstream\n'
+                    % (size, len(data)))
+            f.write(data)
+            f.write(b'\nendstream\nendobj\n')
+            entries = entries.strip() + b' /VeuszScript %d 0 R' % size
+        infonum = size + len(offsets)
+        offsets.append(f.tell())
+        f.write(b'%d 0 obj\n<< %s >>\nendobj\n' % (infonum, entries.strip()))
+        xref = f.tell()
+        f.write(b'xref\n%d %d\n' % (size, len(offsets)))
+        for offset in offsets:
+            f.write(b'%010d 00000 n \n' % offset)
+        f.write(b'trailer\n<< /Size %d %s /Info %d 0 R /Prev %d %s >>\n'
+                % (infonum + 1, root, infonum, prev,
+                   fileid.group(0) if fileid else b''))
+        f.write(b'startxref\n%d\n%%%%EOF\n' % xref)
+
+    def startxref(self, file):
+        file.seek(0, 2)
+        end = file.tell()
+        file.seek(max(0, end - self.tail_size))
+        tail = file.read()
+        pos = tail.rfind(b'startxref')
+        if pos < 0:
+            raise Exception("PDF file has no startxref.")
+        return int(tail[pos + 9:].split()[0])
+
+    def trailer(self, file):
+        """Return the newest trailer dictionary as bytes."""
+        offset = self.startxref(file)
+        file.seek(offset)
+        if not file.read(4) == b'xref':
+            raise Exception("PDF cross-reference streams are not supported.")
+        while True:
+            line = file.readline()
+            if not line:
+                raise Exception("PDF file has no trailer.")
+            if line.strip().startswith(b'trailer'):
+                break
+        trailer = line.strip()[7:]
+        while b'startxref' not in trailer:
+            line = file.readline()
+            if not line:
+                break
+            trailer += line
+        return trailer.split(b'startxref')[0]
+
+    def find_ref(self, data, key):
+        match = re.search(self.ref_pattern % key, data)
+        return int(match.group(1)) if match else None
+
+    def object_offset(self, file, objnum):
+        """
+        Look the object up in the cross-reference sections,
+        following /Prev from the newest section and stopping at the first hit.
+        """
+        offset = self.startxref(file)
+        while offset is not None:
+            file.seek(offset)
+            if file.readline().strip() != b'xref':
+                raise Exception("PDF cross-reference streams are not supported.")
+            while True:
+                line = file.readline().strip()
+                if line.startswith(b'trailer'):
+                    break
+                start, count = (int(x) for x in line.split())
+                if start <= objnum < start + count:
+                    file.seek(20 * (objnum - start), 1)
+                    entry = file.read(20).split()
+                    if entry[2] == b'n':
+                        return int(entry[0])
+                    raise Exception("PDF object %d is free." % objnum)
+                file.seek(20 * count, 1)
+            trailer = line
+            while b'startxref' not in trailer and line:
+                line = file.readline()
+                trailer += line
+            prev = re.search(rb'/Prev\s+(\d+)', trailer)
+            offset = int(prev.group(1)) if prev else None
+        raise Exception("PDF object %d not found." % objnum)
+
+    def scan_object(self, file, offset):
+        """
+        Return the object at offset up to its endobj or stream keyword,
+        skipping over (...) strings, and the offset of that keyword.
+        """
+        file.seek(offset)
+        data = b''
+        pos = depth = 0
+        while True:
+            if pos + 6 >= len(data):
+                block = file.read(4096)
+                if not block and pos >= len(data):
+                    raise Exception("PDF object at %d is truncated." % offset)
+                data += block
+            c = data[pos:pos + 1]
+            if depth:
+                if c == b'\\':
+                    pos += 1
+                elif c == b'(':
+                    depth += 1
+                elif c == b')':
+                    depth -= 1
+            elif c == b'(':
+                depth = 1
+            elif (data.startswith((b'endobj', b'stream'), pos)
+                    and not data[pos - 1:pos].isalnum()):
+                return data[:pos], offset + pos
+            pos += 1
+
+    def read_object(self, file, offset):
+        """Return the body of an object without the stream data."""
+        data, end = self.scan_object(file, offset)
+        return data.split(b'obj', 1)[1]
+
+    def read_stream(self, file, offset):
+        data, end = self.scan_object(file, offset)
+        body = data.split(b'obj', 1)[1]
+        length = int(re.search(rb'/Length\s+(\d+)', body).group(1))
+        file.seek(end)
+        head = file.read(8)
+        start = 6
+        if head[start:start + 2] == b'\r\n':
+            start += 2
+        elif head[start:start + 1] in (b'\r', b'\n'):
+            start += 1
+        file.seek(end + start)
+        return file.read(length)
+
+
+class WebPBackend(ImageBackend):
+    """
+    Script is saved in the XMP chunk of an extended WebP file.
+    Veusz uses lossless WebP encoding when the export quality is 100.
+    """
+    name = 'WebP'
+    extensions = ('.webp',)
+    export_options = {'quality': 100}
+    raster = True
+    XMP_FLAG = 0x04
+    ALPHA_FLAG = 0x10
+
+    def sniff(self, head):
+        return head[:4] == b'RIFF' and head[8:12] == b'WEBP'
+
+    def chunks(self, file):
+        """Yield (fourcc, size) of each chunk, positioned at its data."""
+        header = file.read(12)
+        if not self.sniff(header):
+            raise Exception("WebP file has invalid signature.")
+        (riffsize,) = struct.unpack('<I', header[4:8])
+        remaining = riffsize - 4
+        while remaining >= 8:
+            fourcc, size = struct.unpack('<4sI', file.read(8))
+            yield fourcc, size
+            remaining -= 8 + size + (size & 1)
+
+    def extract(self, file):
+        for fourcc, size in self.chunks(file):
+            if fourcc == b'XMP ':
+                return script_from_xmp(file.read(size))
+            skip_bytes(file, size + (size & 1))
+        return ''
+
+    def embed_stream(self, src, out, script):
+        """
+        Copy the chunks, putting the script into the XMP packet. XMP written
+        by other tools is kept, and only the Veusz property is replaced.
+        """
+        start = out.tell()
+        out.write(b'RIFF\0\0\0\0WEBP')
+        vp8x = None
+        has_xmp = False
+        for fourcc, size in self.chunks(src):
+            padded = size + (size & 1)
+            if fourcc == b'XMP ':
+                xmp = merge_xmp(src.read(padded)[:size], script)
+                script = None
+                if xmp is not None:
+                    self.write_chunk(out, b'XMP ', xmp)
+                    has_xmp = True
+                continue
+            if fourcc == b'VP8X':
+                vp8x = out.tell() + 8
+                out.write(struct.pack('<4sI', fourcc, size))
+                copy_bytes(src, out, padded)
+                continue
+            if (fourcc in (b'VP8 ', b'VP8L') and out.tell() == start + 12
+                    and script is not None):
+                head = src.read(min(10, size))
+                vp8x = out.tell() + 8
+                out.write(self.vp8x_chunk(fourcc, head))
+                out.write(struct.pack('<4sI', fourcc, size) + head)
+                copy_bytes(src, out, padded - len(head))
+                continue
+            out.write(struct.pack('<4sI', fourcc, size))
+            copy_bytes(src, out, padded)
+        if script is not None:
+            self.write_chunk(out, b'XMP ', xmp_packet(script))
+            has_xmp = True
+        end = out.tell()
+        if vp8x is not None:
+            out.seek(vp8x)
+            flags = out.read(1)[0]
+            if has_xmp:
+                flags |= self.XMP_FLAG
+            else:
+                flags &= ~self.XMP_FLAG
+            out.seek(vp8x)
+            out.write(bytes([flags]))
+        out.seek(start + 4)
+        out.write(struct.pack('<I', end - start - 8))
+        out.seek(end)
+
+    def write_chunk(self, out, fourcc, data):
+        out.write(struct.pack('<4sI', fourcc, len(data)) + data)
+        if len(data) & 1:
+            out.write(b'\0')
+
+    def vp8x_chunk(self, fourcc, head):
+        """Make the extended header for a simple lossy or lossless file."""
+        flags = self.XMP_FLAG
+        if fourcc == b'VP8L':
+            (bits,) = struct.unpack('<I', head[1:5])
+            width = (bits & 0x3fff) + 1
+            height = ((bits >> 14) & 0x3fff) + 1
+            if bits >> 28 & 1:
+                flags |= self.ALPHA_FLAG
+        else:
+            width, height = struct.unpack('<HH', head[6:10])
+            width &= 0x3fff
+            height &= 0x3fff
+        data = struct.pack('<B3x', flags)
+        data += struct.pack('<I', width - 1)[:3] + struct.pack('<I', height - 1)[:3]
+        return struct.pack('<4sI', b'VP8X', len(data)) + data
+
+
+RDF_NAMESPACE = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+XMPMETA_TAG = '{adobe:ns:meta/}xmpmeta'
+
+
+def xmp_packet(script):
+    """Wrap the script in an XMP packet."""
+    xmpmeta = ET.Element(XMPMETA_TAG)
+    set_xmp_script(xmpmeta, script)
+    return wrap_xmp(xmpmeta)
+
+
+def wrap_xmp(xmpmeta):
+    return (b'<?xpacket begin="\xef\xbb\xbf" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+            + ET.tostring(xmpmeta, encoding='utf-8', xml_declaration=False)
+            + b'<?xpacket end="w"?>')
+
+
+def set_xmp_script(xmpmeta, script):
+    """Put the script property into the first rdf:Description."""
+    rdf = xmpmeta.find(f'{RDF_NAMESPACE}RDF')
+    if rdf is None:
+        rdf = ET.SubElement(xmpmeta, f'{RDF_NAMESPACE}RDF')
+    description = rdf.find(f'{RDF_NAMESPACE}Description')
+    if description is None:
+        description = ET.SubElement(
+            rdf, f'{RDF_NAMESPACE}Description', {f'{RDF_NAMESPACE}about': ''})
+    ET.SubElement(description, f'{VEUSZ_NAMESPACE}script').text = script
+
+
+def merge_xmp(data, script):
+    """
+    Return the XMP packet with the Veusz script replaced by `script`, or
+    removed if it is None. Packets without the script are returned as they
+    are when there is nothing to add, and None is returned if nothing but
+    the empty packet structure would remain.
+    """
+    try:
+        xmpmeta = ET.fromstring(data)
+    except ET.ParseError:
+        if script is None:
+            return data
+        raise Exception("Cannot add the script to a malformed XMP packet.")
+    if xmpmeta.tag != XMPMETA_TAG:
+        xmpmeta = xmpmeta.find(f'.//{XMPMETA_TAG}')
+        if xmpmeta is None:
+            raise Exception("XMP packet has no x:xmpmeta element.")
+    found = False
+    for parent in list(xmpmeta.iter()):
+        for child in list(parent):
+            if child.tag == f'{VEUSZ_NAMESPACE}script':
+                parent.remove(child)
+                found = True
+    if script is not None:
+        set_xmp_script(xmpmeta, script)
+        return wrap_xmp(xmpmeta)
+    if not found:
+        return data
+    structure = (XMPMETA_TAG, f'{RDF_NAMESPACE}RDF', f'{RDF_NAMESPACE}Description')
+    for elem in xmpmeta.iter():
+        if elem.tag not in structure:
+            return wrap_xmp(xmpmeta)
+        if elem.tag == structure[2] and set(elem.attrib) - {f'{RDF_NAMESPACE}about'}:
+            return wrap_xmp(xmpmeta)
+    return None
+
+
+def script_from_xmp(data):
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError:
+        return ''
+    vszdata = root.find(f'.//{VEUSZ_NAMESPACE}script')
+    if vszdata is None:
+        return ''
+    return vszdata.text or ''
+
+
+class PNGReader:
+    """
+    This is a subclass extracted from the library pypng (https://github.com/drj11/pypng)
+    with removal of some unused functions.
+    Declared chunk lengths are checked against the size of seekable files
+    before reading, and `max_chunk` limits the octets read for one chunk.
+    """
+    def __init__(self, _guess=None, filename=None, file=None, bytes=None,
+                 max_chunk=None):
+        keywords_supplied = (
+            (_guess is not None) +
+            (filename is not None) +
+            (file is not None) +
+            (bytes is not None))
+        if keywords_supplied != 1:
+            raise TypeError("PNGReader() takes exactly 1 argument")
+        self.signature = None
+        self.transparent = None
+        self.atchunk = None
+        self.size = None
+        self.max_chunk = max_chunk
+        if _guess is not None:
+            if isinstance(_guess, array):
+                bytes = _guess
+            elif isinstance(_guess, str):
+                filename = _guess
+            elif hasattr(_guess, 'read'):
+                file = _guess
+        if bytes is not None:
+            self.file = io.BytesIO(bytes)
+        elif filename is not None:
+            self.file = open(filename, "rb")
+        elif file is not None:
+            self.file = file
+        else:
+            raise Exception("expecting filename, file or bytes array")
+
+    def chunk(self, lenient=False):
+        self.validate_signature()
+        if not self.atchunk:
+            self.atchunk = self._chunk_len_type()
+        if not self.atchunk:
+            raise Exception("No more chunks.")
+        length, type = self.atchunk
+        self.atchunk = None
+
+        if self.max_chunk is not None and length > self.max_chunk:
+            raise Exception(
+                'Chunk %s of %i octets exceeds the budget of %i octets.'
+                % (type, length, self.max_chunk))
+        data = self._read(length)
+        if len(data) != length:
+            raise Exception(
+                'Chunk %s too short for required %i octets.'
+                % (type, length))
+        checksum = self.file.read(4)
+        if len(checksum) != 4:
+            raise Exception('Chunk %s too short for checksum.' % type)
+        verify = zlib.crc32(type)
+        verify = zlib.crc32(data, verify)
+        verify &= 2**32 - 1
+        verify = struct.pack('!I', verify)
+        if checksum != verify:
+            (a, ) = struct.unpack('!I', checksum)
+            (b, ) = struct.unpack('!I', verify)
+            message = ("Checksum error in %s chunk: 0x%08X != 0x%08X."
+                    % (type.decode('ascii'), a, b))
+            if lenient:
+                warnings.warn(message, RuntimeWarning)
+            else:
+                raise Exception(message)
+        return type, data
+
+    def chunks(self):
+        while True:
+            t, v = self.chunk()
+            yield t, v
+            if t == b'IEND':
+                break
+
+    def next_type(self):
+        """Return the type of the next chunk without reading its data."""
+        self.validate_signature()
+        if not self.atchunk:
+            self.atchunk = self._chunk_len_type()
+        if not self.atchunk:
+            raise Exception("No more chunks.")
+        return self.atchunk[1]
+
+    def skip(self):
+        """Skip the data and checksum of the next chunk."""
+        self.next_type()
+        length, type = self.atchunk
+        self.atchunk = None
+        skip_bytes(self.file, length + 4)
+
+    def validate_signature(self):
+        if self.signature:
+            return
+        self.signature = self.file.read(8)
+        if self.signature != PNG_SIGNATURE:
+            raise Exception("PNG file has invalid signature.")
+
+    def _chunk_len_type(self):
+        x = self.file.read(8)
+        if not x:
+            return None
+        if len(x) != 8:
+            raise Exception(
+                'End of file whilst reading chunk length and type.')
+        length, type = struct.unpack('!I4s', x)
+        if length > 2 ** 31 - 1:
+            raise Exception('Chunk %s is too large: %d.' % (type, length))
+        remaining = self._remaining()
+        if remaining is not None and length + 4 > remaining:
+            raise Exception(
+                'Chunk %s too short for required %i octets.'
+                % (type, length))
+        type_bytes = set(bytearray(type))
+        if not(type_bytes <= set(range(65, 91)) | set(range(97, 123))):
+            raise Exception(
+                'Chunk %r has invalid Chunk Type.'
+                % list(type))
+        return length, type
+
+    def _read(self, length):
+        """
+        Read up to `length` octets. When the file size is unknown, read in
+        blocks so that memory only grows with the data actually present.
+        """
+        if self._remaining() is not None:
+            return self.file.read(length)
+        blocks = []
+        while length > 0:
+            block = self.file.read(min(length, COPY_BLOCK))
+            if not block:
+                break
+            blocks.append(block)
+            length -= len(block)
+        return b''.join(blocks)
+
+    def _remaining(self):
+        """Return the number of octets left in the file, or None if unknown."""
+        if self.size is None:
+            self.size = -1
+            try:
+                if self.file.seekable():
+                    pos = self.file.tell()
+                    self.size = self.file.seek(0, 2)
+                    self.file.seek(pos)
+            except (AttributeError, OSError):
+                pass
+        if self.size < 0:
+            return None
+        return self.size - self.file.tell()
+
+
+backendregistry.append(PNGBackend)
+backendregistry.append(SVGBackend)
+backendregistry.append(SVGZBackend)
+backendregistry.append(PDFBackend)
+backendregistry.append(WebPBackend)
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Canonical form of Veusz scripts.
+
+A script saved by Veusz is replayed through `StubInterface`, which records
+the widget tree and the data commands without Veusz, and written out again:
+comments other than the "# Veusz" header are dropped, overwritten settings
+and settings equal to the given widget defaults are dropped, navigation is
+reduced to one To() into and out of each widget, and values are written
+with repr() so that numbers have a single spelling. AddImportPath() of the
+temporary directory the script was saved in is replaced or dropped. The
+result is replayed again and the original script is returned unless both
+give the same document. Identical figures therefore give identical scripts.
+"""
+import ast, os, tempfile
+
+DATA_COMMANDS = (
+    'AddCustom', 'AddImportPath', 'SetCompatLevel', 'TagDatasets')
+DATA_PREFIXES = ('Import', 'SetData')
+
+
+class UnsupportedScript(Exception):
+    """The script uses commands which cannot be canonicalized safely."""
+
+
+class Node:
+    """Widget recorded by StubInterface."""
+    def __init__(self, widgettype, name, parent=None, addargs=None):
+        self.widgettype = widgettype
+        self.name = name
+        self.parent = parent
+        self.addargs = addargs or {}
+        self.settings = {}
+        self.children = []
+
+    def child(self, name):
+        for child in self.children:
+            if child.name == name:
+                return child
+        raise UnsupportedScript("No widget %s" % name)
+
+    def state(self, defaults):
+        """Return the widget and its descendants as comparable tuples."""
+        typedefaults = defaults.get(self.widgettype, {})
+        settings = tuple(
+            (path, value) for (path, value) in self.settings.items()
+            if not (value[0] == 'Set' and path in typedefaults
+                    and typedefaults[path] == value[1]))
+        return (self.widgettype, self.name, tuple(sorted(self.addargs.items())),
+                tuple(sorted(settings)),
+                tuple(child.state(defaults) for child in self.children))
+
+
+class StubInterface:
+    """Stand-in for the Veusz command interface which records the document."""
+    def __init__(self):
+        self.root = Node('document', '')
+        self.cwd = self.root
+        self.commands = []
+
+    def Add(self, widgettype, name=None, **addargs):
+        if name is None:
+            raise UnsupportedScript("Add() without a widget name")
+        if any(child.name == name for child in self.cwd.children):
+            raise UnsupportedScript("Duplicate widget %s" % name)
+        self.cwd.children.append(Node(widgettype, name, self.cwd, addargs))
+
+    def To(self, path):
+        node = self.root if path.startswith('/') else self.cwd
+        for part in path.split('/'):
+            if part in ('', '.'):
+                continue
+            elif part == '..':
+                if node.parent is None:
+                    raise UnsupportedScript("To() above the document")
+                node = node.parent
+            else:
+                node = node.child(part)
+        self.cwd = node
+
+    def setting(self, path):
+        """
+        Return the widget a setting path belongs to and the path relative to
+        it. Leading parts naming widgets are resolved, as Veusz does, so that
+        the setting is written inside the widget it changes.
+        """
+        node = self.root if path.startswith('/') else self.cwd
+        parts = [part for part in path.split('/') if part not in ('', '.')]
+        if not parts:
+            raise UnsupportedScript("Empty setting path")
+        while len(parts) > 1:
+            if parts[0] == '..':
+                if node.parent is None:
+                    raise UnsupportedScript("Setting above the document")
+                node = node.parent
+            else:
+                children = [child for child in node.children if child.name == parts[0]]
+                if not children:
+                    break
+                node = children[0]
+            del parts[0]
+        return node, '/'.join(parts)
+
+    def Set(self, path, value):
+        node, path = self.setting(path)
+        node.settings[path] = ('Set', value)
+
+    def SetToReference(self, path, value):
+        node, path = self.setting(path)
+        node.settings[path] = ('SetToReference', value)
+
+    def call(self, name, args, kwargs):
+        if name in ('Add', 'To', 'Set', 'SetToReference'):
+            getattr(self, name)(*args, **kwargs)
+        elif name in DATA_COMMANDS or name.startswith(DATA_PREFIXES):
+            if self.root.children:
+                raise UnsupportedScript("%s() after widgets" % name)
+            self.commands.append((name, args, tuple(sorted(kwargs.items()))))
+        else:
+            raise UnsupportedScript("Unsupported command %s()" % name)
+
+    def state(self, defaults=None):
+        return (tuple(self.commands), self.root.state(defaults or {}))
+
+
+def replay(script):
+    """Run the script through a StubInterface, without executing any code."""
+    try:
+        tree = ast.parse(script)
+    except SyntaxError as e:
+        raise UnsupportedScript(str(e))
+    interface = StubInterface()
+    for stmt in tree.body:
+        if not (isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Call)
+                and isinstance(stmt.value.func, ast.Name)):
+            raise UnsupportedScript("Statement is not a command call")
+        call = stmt.value
+        try:
+            args = [ast.literal_eval(arg) for arg in call.args]
+            kwargs = {kw.arg: ast.literal_eval(kw.value) for kw in call.keywords}
+        except ValueError:
+            raise UnsupportedScript("Non-literal argument in %s()" % call.func.id)
+        if None in kwargs:
+            raise UnsupportedScript("**kwargs in %s()" % call.func.id)
+        interface.call(call.func.id, args, kwargs)
+    return interface
+
+
+def format_call(name, args, kwargs=()):
+    items = [repr(arg) for arg in args]
+    items += ['%s=%r' % (key, value) for (key, value) in kwargs]
+    return '%s(%s)' % (name, ', '.join(items))
+
+
+def write_node(node, lines, defaults):
+    typedefaults = defaults.get(node.widgettype, {})
+    for path, (command, value) in node.settings.items():
+        if command == 'Set' and path in typedefaults and typedefaults[path] == value:
+            continue
+        lines.append(format_call(command, (path, value)))
+    for child in node.children:
+        kwargs = [('name', child.name)] + list(child.addargs.items())
+        lines.append(format_call('Add', (child.widgettype,), kwargs))
+        body = []
+        write_node(child, body, defaults)
+        if body:
+            lines.append(format_call('To', (child.name,)))
+            lines.extend(body)
+            lines.append(format_call('To', ('..',)))
+
+
+def is_temporary_dir(path):
+    """Return True for a directory made by tempfile, such as a save location."""
+    path = os.path.normpath(os.path.abspath(path))
+    return (os.path.dirname(path) == os.path.normpath(tempfile.gettempdir())
+            and os.path.basename(path).startswith('tmp'))
+
+
+def normalize_import_paths(script, importpath=None):
+    """
+    Replace AddImportPath() lines naming a temporary directory with
+    `importpath`, or drop them if it is None. Veusz writes the directory the
+    script is saved in, which is a new temporary one on every save.
+    """
+    lines = []
+    for line in script.split('\n'):
+        if line.startswith('AddImportPath('):
+            try:
+                path = ast.literal_eval(ast.parse(line).body[0].value.args[0])
+            except (SyntaxError, ValueError, IndexError, AttributeError):
+                path = None
+            if isinstance(path, str) and is_temporary_dir(path):
+                if importpath is None:
+                    continue
+                line = format_call('AddImportPath', (importpath,))
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def drop_comment_header(script):
+    """
+    Keep the "# Veusz" line of the leading comment header and drop the
+    rest of it, such as the "# Saved at" time which changes on every save.
+    """
+    lines = script.split('\n')
+    header = lines[:1] if lines[0].startswith('# Veusz') else []
+    del lines[:len(header)]
+    while lines and (lines[0].startswith('#') or not lines[0].strip()):
+        del lines[0]
+    return '\n'.join(header + lines)
+
+
+def canonicalize_script(script, defaults=None, importpath=None):
+    """
+    Return the canonical form of the script, or the script itself if it
+    cannot be canonicalized with the same meaning.
+    `defaults` maps widget types to {setting path: default value}.
+    `importpath` replaces an AddImportPath() of a temporary directory.
+    """
+    defaults = defaults or {}
+    header = script.split('\n', 1)[0]
+    if not header.startswith('# Veusz'):
+        return script
+    script = normalize_import_paths(script, importpath)
+    try:
+        interface = replay(script)
+        lines = [header]
+        for name, args, kwargs in interface.commands:
+            lines.append(format_call(name, args, kwargs))
+        write_node(interface.root, lines, defaults)
+        canonical = '\n'.join(lines) + '\n'
+        if replay(canonical).state(defaults) != interface.state(defaults):
+            return script
+    except UnsupportedScript:
+        return script
+    return canonical
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Command-line tool to embed and extract Veusz scripts without Veusz.
+
+    python vszimg_cli.py extract fig.png            # writes fig.vsz
+    python vszimg_cli.py extract - < fig.png > fig.vsz
+    python vszimg_cli.py embed fig.vsz a.png b.pdf
+    python vszimg_cli.py embed fig.vsz - < a.png > b.png
+    python vszimg_cli.py strip *.png
+    python vszimg_cli.py info --files-from list.txt
+
+Many files can be handled by one invocation. The path "-" means stdin for
+the input image and stdout for the output, and stdin can only be read once.
+PNG, WebP and PDF images are streamed with bounded memory; PDF input from
+stdin is spooled to a temporary file. SVG and SVGZ images are parsed into
+a full element tree, so their memory grows with the size of the image.
+"""
+from vszimg_backends import SNIFF_SIZE, PNGBackend, find_backend, detect_backend
+from vszimg_store import resolve_script
+import argparse, io, os, shutil, sys, tempfile
+
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+class PrefixedStream(io.RawIOBase):
+    """Raw stream which returns `head` before the rest of `file`."""
+    def __init__(self, head, file):
+        self.head = head
+        self.file = file
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.head:
+            data, self.head = self.head[:len(b)], self.head[len(b):]
+        else:
+            data = self.file.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def open_stdin():
+    """
+    Return the backend and a binary stream of the image on stdin.
+    Backends which need random access get a spooled copy of stdin.
+    """
+    stdin = sys.stdin.buffer
+    head = stdin.read(SNIFF_SIZE)
+    backend = find_backend(head)
+    if backend is None:
+        raise Exception("Unsupported image format: -")
+    src = io.BufferedReader(PrefixedStream(head, stdin))
+    if not backend.streamable:
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        shutil.copyfileobj(src, spool)
+        spool.seek(0)
+        src = spool
+    return backend, src
+
+
+def read_image_script(path):
+    if path == '-':
+        backend, src = open_stdin()
+        return backend, backend.extract(src)
+    backend = detect_backend(path)
+    if backend is None:
+        raise Exception("Unsupported image format: %s" % path)
+    return backend, backend.read_script(path)
+
+
+def write_stdout(script):
+    """Stream the image on stdin to stdout with the script replaced."""
+    backend, src = open_stdin()
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as out:
+        backend.embed_stream(src, out, script)
+        out.seek(0)
+        shutil.copyfileobj(out, sys.stdout.buffer)
+    sys.stdout.buffer.flush()
+
+
+def cmd_extract(args, path):
+    backend, script = read_image_script(path)
+    if not script:
+        raise Exception("No Veusz script in %s" % path)
+    script = resolve_script(script, path)
+    if path == '-':
+        sys.stdout.write(script)
+        return
+    outdir = args.outdir or os.path.dirname(path)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    with open(os.path.join(outdir, stem + '.vsz'), 'w', encoding='utf-8') as f:
+        f.write(script)
+
+
+def cmd_embed(args, path):
+    if path == '-':
+        write_stdout(args.script_text)
+        return
+    backend = detect_backend(path)
+    if backend is None:
+        raise Exception("Unsupported image format: %s" % path)
+    backend.embed(path, args.script_text)
+
+
+def cmd_strip(args, path):
+    if path == '-':
+        write_stdout(None)
+        return
+    backend = detect_backend(path)
+    if backend is None:
+        raise Exception("Unsupported image format: %s" % path)
+    backend.strip(path)
+
+
+def cmd_info(args, path):
+    backend, script = read_image_script(path)
+    firstline = script.split('\n', 1)[0] if script else ''
+    print('%s\t%s\t%d\t%s' % (path, backend.name, len(script), firstline))
+
+
+def iter_paths(args):
+    for path in args.files:
+        yield path
+    if args.files_from:
+        f = sys.stdin if args.files_from == '-' else open(args.files_from)
+        with f:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if line:
+                    yield line
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog='vszimg', description='Embed and extract Veusz scripts in images.')
+    parser.add_argument(
+        '--max-chunk', type=int, metavar='OCTETS',
+        help='refuse PNG chunks or compressed scripts larger than this '
+             '(default: %d, 0 for no limit)' % PNGBackend.max_chunk)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_command(name, func, help):
+        sub = commands.add_parser(name, help=help)
+        sub.set_defaults(func=func)
+        return sub
+
+    extract = add_command('extract', cmd_extract, 'write scripts as .vsz files')
+    extract.add_argument(
+        '-d', '--outdir', help='directory of .vsz files (default: next to images)')
+    embed = add_command('embed', cmd_embed, 'embed a script into images')
+    embed.add_argument('script', help='.vsz script file, or - for stdin')
+    add_command('strip', cmd_strip, 'remove scripts from images')
+    add_command('info', cmd_info, 'print path, format, script size and header')
+    for sub in commands.choices.values():
+        sub.add_argument('files', nargs='*', help='image files, or - for stdin')
+        sub.add_argument(
+            '-@', '--files-from', metavar='LIST',
+            help='read image paths from LIST, one per line (- for stdin)')
+    return parser
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    stdin_uses = int(args.files_from == '-')
+    if args.command == 'embed' and args.script == '-':
+        stdin_uses += 1
+    if stdin_uses + args.files.count('-') > 1:
+        parser.error('stdin ("-") can only be used once')
+    if args.max_chunk is not None:
+        PNGBackend.max_chunk = args.max_chunk or None
+    if args.command == 'embed':
+        if args.script == '-':
+            args.script_text = sys.stdin.read()
+        else:
+            with open(args.script, encoding='utf-8') as f:
+                args.script_text = f.read()
+    status = 0
+    for path in iter_paths(args):
+        if path == '-':
+            stdin_uses += 1
+            if stdin_uses > 1:
+                print('vszimg: -: stdin can only be used once', file=sys.stderr)
+                status = 1
+                continue
+        try:
+            args.func(args, path)
+        except Exception as e:
+            print('vszimg: %s: %s' % (path, e), file=sys.stderr)
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
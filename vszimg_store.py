@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed store of Veusz scripts shared by many images.
+
+Instead of the script, an image holds a short reference:
+
+    # Veusz script reference
+    # sha256: <hex digest of the script>
+    # store: <path of the store relative to the image>
+    # fallback: <base64 of the zlib-compressed script>
+
+The store is a directory (<store>/<2 hex>/<62 hex>.vsz) or an SQLite file
+(*.sqlite, *.sqlite3 or *.db). Scripts up to `INLINE_LIMIT` bytes are still
+embedded directly. The compressed fallback is used when the store cannot be
+read. A reference only holds comments, so running it as a script leaves
+the document unchanged.
+"""
+from vszimg_canon import drop_comment_header, normalize_import_paths
+import base64, functools, hashlib, os, pathlib, re, sqlite3, tempfile, zlib
+
+REFERENCE_HEADER = '# Veusz script reference'
+INLINE_LIMIT = 256
+reference_pattern = re.compile(
+    r'# sha256: (?P<digest>[0-9a-f]{64})\n# store: (?P<store>.*)'
+    r'(?:\n# fallback: (?P<fallback>[A-Za-z0-9+/=]+))?')
+
+
+def script_digest(script):
+    return hashlib.sha256(bytes(script, 'utf-8')).hexdigest()
+
+
+class DirectoryScriptStore:
+    """Scripts saved as files named by their digest."""
+    def __init__(self, path):
+        self.path = path
+
+    def filepath(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:] + '.vsz')
+
+    def put(self, script):
+        digest = script_digest(script)
+        filepath = self.filepath(digest)
+        if not os.path.exists(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(filepath))
+            with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+                f.write(script)
+            os.replace(tmppath, filepath)
+        return digest
+
+    def get(self, digest):
+        if not os.path.isdir(self.path):
+            raise Exception("Script store not found: %s" % self.path)
+        try:
+            with open(self.filepath(digest), encoding='utf-8', newline='') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise Exception(
+                "Script %s is missing from the store %s" % (digest, self.path))
+
+
+class SQLiteScriptStore:
+    """Scripts saved compressed in an SQLite table keyed by their digest."""
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS scripts '
+            '(digest TEXT PRIMARY KEY, script BLOB NOT NULL)')
+        return conn
+
+    def put(self, script):
+        digest = script_digest(script)
+        data = zlib.compress(bytes(script, 'utf-8'), 9)
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute(
+                    'INSERT OR IGNORE INTO scripts VALUES (?, ?)', (digest, data))
+        finally:
+            conn.close()
+        return digest
+
+    def get(self, digest):
+        """Look the script up, opening the store read-only."""
+        if not os.path.isfile(self.path):
+            raise Exception("Script store not found: %s" % self.path)
+        uri = pathlib.Path(os.path.abspath(self.path)).as_uri() + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True)
+        try:
+            row = conn.execute(
+                'SELECT script FROM scripts WHERE digest = ?', (digest,)).fetchone()
+        except sqlite3.DatabaseError as e:
+            raise Exception("Cannot read the script store %s: %s" % (self.path, e))
+        finally:
+            conn.close()
+        if row is None:
+            raise Exception(
+                "Script %s is missing from the store %s" % (digest, self.path))
+        return zlib.decompress(row[0]).decode('utf-8')
+
+
+def open_store(path):
+    if path.lower().endswith(('.sqlite', '.sqlite3', '.db')):
+        return SQLiteScriptStore(path)
+    return DirectoryScriptStore(path)
+
+
+def store_script(script, storepath, imagepath, inline_limit=INLINE_LIMIT):
+    """
+    Put the script into the store and return the reference to embed
+    into the image, or the script itself if it is small. The save time in
+    the comment header is dropped and the temporary directory Veusz writes
+    as AddImportPath() is replaced with the image's directory first, so
+    that every save of a document gets the same digest.
+    """
+    script = normalize_import_paths(
+        drop_comment_header(script), os.path.dirname(os.path.abspath(imagepath)))
+    if len(bytes(script, 'utf-8')) <= inline_limit:
+        return script
+    digest = open_store(storepath).put(script)
+    try:
+        relpath = os.path.relpath(
+            os.path.abspath(storepath), os.path.dirname(os.path.abspath(imagepath)))
+    except ValueError:
+        relpath = os.path.abspath(storepath)
+    relpath = relpath.replace(os.sep, '/')
+    fallback = base64.b64encode(zlib.compress(bytes(script, 'utf-8'), 9))
+    return '%s\n# sha256: %s\n# store: %s\n# fallback: %s\n' % (
+        REFERENCE_HEADER, digest, relpath, fallback.decode('ascii'))
+
+
+@functools.lru_cache(maxsize=128)
+def lookup(storepath, digest):
+    script = open_store(storepath).get(digest)
+    if script_digest(script) != digest:
+        raise Exception("Script %s in %s is corrupted." % (digest, storepath))
+    return script
+
+
+def resolve_script(text, imagepath):
+    """
+    Return the script referenced by an embedded text, or the text itself.
+    The inline fallback is used if the store cannot give the script.
+    """
+    if not text.startswith(REFERENCE_HEADER):
+        return text
+    match = reference_pattern.search(text)
+    if match is None:
+        raise Exception("Invalid script reference in %s" % imagepath)
+    storepath = os.path.join(
+        os.path.dirname(os.path.abspath(imagepath)), match.group('store'))
+    try:
+        return lookup(os.path.normpath(storepath), match.group('digest'))
+    except Exception:
+        if match.group('fallback') is None:
+            raise
+    try:
+        script = zlib.decompress(base64.b64decode(match.group('fallback')))
+        script = script.decode('utf-8')
+    except (ValueError, zlib.error):
+        script = None
+    if script is None or script_digest(script) != match.group('digest'):
+        raise Exception("Inline fallback of the script in %s is corrupted." % imagepath)
+    return script
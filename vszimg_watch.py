@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Batch export and watch mode for Veusz-images.
+
+    python vszimg_watch.py figs/ --format PNG --once   # export every .vsz once
+    python vszimg_watch.py figs/ a.vsz --format SVG    # keep outputs current
+
+Each page of a .vsz document is exported next to it (or into --outdir) and
+the document script is embedded into it. A page is exported again only when
+its hash changes. The hash covers the document-level part of the script,
+the commands of the page and the content of the data files imported by the
+document. The hashes of the written images are kept in a manifest file,
+with a digest of the whole script. Since every image embeds the whole
+script, images of unchanged pages get the new script embedded without
+being exported again when another page changes.
+Files are watched by polling modification times and sizes, and changes are
+handled after they have settled for the debounce time.
+"""
+from vszimg_backends import backend_by_name, backendregistry
+import argparse, ast, hashlib, json, os, re, sys, time
+
+MANIFEST = '.vszimg-manifest.json'
+page_add = re.compile(r"""^Add\(\s*['"]page['"]""")
+
+
+def split_pages(script):
+    """
+    Return the document-level lines and the lines of each page.
+    Pages are started by an Add('page', ...) at the root of the document.
+    The leading comment header, which holds the save time, is left out.
+    """
+    shared, pages = [], []
+    depth = 0
+    lines = script.splitlines()
+    while lines and (lines[0].startswith('#') or not lines[0].strip()):
+        del lines[0]
+    for line in lines:
+        stripped = line.strip()
+        if depth == 0 and page_add.match(stripped):
+            pages.append([])
+        if stripped.startswith('To('):
+            target = stripped[3:].strip("()'\" ")
+            if target == '/':
+                depth = 0
+            else:
+                for part in target.split('/'):
+                    depth += -1 if part == '..' else 1
+                depth = max(depth, 0)
+        if pages and (depth > 0 or page_add.match(stripped)
+                      or stripped.startswith('To(')):
+            pages[-1].append(line)
+        else:
+            shared.append(line)
+    return shared, pages
+
+
+def data_files(script, vszpath):
+    """Return the existing files named by the Import commands of the script."""
+    dirs = [os.path.dirname(os.path.abspath(vszpath))]
+    try:
+        tree = ast.parse(script)
+    except SyntaxError:
+        return []
+    files = []
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)):
+            continue
+        args = node.args + [kw.value for kw in node.keywords]
+        strings = [a.value for a in args
+                   if isinstance(a, ast.Constant) and isinstance(a.value, str)]
+        if node.func.id == 'AddImportPath':
+            dirs.extend(strings)
+        elif node.func.id.startswith('Import'):
+            for name in strings:
+                if '\n' in name:
+                    continue
+                for d in dirs:
+                    path = os.path.join(d, name)
+                    if os.path.isfile(path):
+                        files.append(os.path.abspath(path))
+                        break
+    return sorted(set(files))
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def page_hashes(script, vszpath):
+    """Return a content hash for each page of the document."""
+    shared, pages = split_pages(script)
+    base = hashlib.sha256('\n'.join(shared).encode('utf-8'))
+    for path in data_files(script, vszpath):
+        base.update(file_digest(path).encode('ascii'))
+    hashes = []
+    for lines in pages:
+        h = base.copy()
+        h.update('\n'.join(lines).encode('utf-8'))
+        hashes.append(h.hexdigest())
+    return hashes
+
+
+def output_path(vszpath, page, npages, backend, outdir=None):
+    stem = os.path.splitext(os.path.basename(vszpath))[0]
+    if npages > 1:
+        stem += '-%d' % (page + 1)
+    outdir = outdir or os.path.dirname(vszpath)
+    return os.path.join(outdir, stem + backend.extensions[0])
+
+
+def export_pages(vszpath, script, targets):
+    """
+    Load the document into a hidden Veusz window once and export the
+    (page, filepath, backend) targets with the script embedded.
+    """
+    import veusz.embed
+    doc = veusz.embed.Embedded(hidden=True)
+    try:
+        doc.Load(vszpath)
+        for page, filepath, backend in targets:
+            backend.export(doc, filepath, page)
+            backend.embed(filepath, script)
+    finally:
+        doc.Close()
+
+
+class Watcher:
+    """Keep the images of a set of .vsz documents current."""
+    def __init__(self, paths, backend, outdir=None, exporter=export_pages):
+        self.paths = paths
+        self.backend = backend
+        self.outdir = outdir
+        self.exporter = exporter
+        self.deps = {}
+
+    def documents(self):
+        docs = []
+        for path in self.paths:
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    docs.extend(os.path.join(dirpath, f)
+                                for f in sorted(filenames) if f.endswith('.vsz'))
+            elif os.path.isfile(path):
+                docs.append(path)
+        return docs
+
+    def manifest_path(self, vszpath):
+        return os.path.join(self.outdir or os.path.dirname(vszpath), MANIFEST)
+
+    def update(self, vszpath):
+        """
+        Export the pages of the document whose hash has changed, and embed
+        the script again into the other images if it has changed.
+        Return the lists of exported and of re-embedded images.
+        """
+        with open(vszpath, encoding='utf-8') as f:
+            script = f.read()
+        self.deps[vszpath] = data_files(script, vszpath)
+        hashes = page_hashes(script, vszpath)
+        scriptdigest = hashlib.sha256(script.encode('utf-8')).hexdigest()
+        manifest_path = self.manifest_path(vszpath)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        targets, stale = [], []
+        for page, digest in enumerate(hashes):
+            filepath = output_path(vszpath, page, len(hashes), self.backend, self.outdir)
+            entry = manifest.get(filepath)
+            if not isinstance(entry, dict):
+                entry = {}
+            if entry.get('page') != digest or not os.path.exists(filepath):
+                targets.append((page, filepath, self.backend))
+            elif entry.get('script') != scriptdigest:
+                stale.append(filepath)
+            manifest[filepath] = {'page': digest, 'script': scriptdigest}
+        if targets:
+            self.exporter(vszpath, script, targets)
+        for filepath in stale:
+            self.backend.embed(filepath, script)
+        if targets or stale:
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+        return [filepath for page, filepath, backend in targets], stale
+
+    def snapshot(self):
+        """Return the modification state of every watched file."""
+        state = {}
+        for vszpath in self.documents():
+            for path in [vszpath] + self.deps.get(vszpath, []):
+                try:
+                    st = os.stat(path)
+                    state.setdefault(vszpath, []).append(
+                        (path, st.st_mtime_ns, st.st_size))
+                except OSError:
+                    state.setdefault(vszpath, []).append((path, None, None))
+        return state
+
+    def update_all(self, docs):
+        for vszpath in docs:
+            try:
+                exported, embedded = self.update(vszpath)
+                for filepath in exported:
+                    print('exported %s' % filepath)
+                for filepath in embedded:
+                    print('embedded script into %s' % filepath)
+            except Exception as e:
+                print('vszimg-watch: %s: %s' % (vszpath, e), file=sys.stderr)
+
+    def watch(self, interval=1.0, debounce=2.0):
+        self.update_all(self.documents())
+        state = self.snapshot()
+        pending = set()
+        changed_at = None
+        while True:
+            time.sleep(interval)
+            current = self.snapshot()
+            changed = {doc for doc in current if current[doc] != state.get(doc)}
+            state = current
+            if changed:
+                pending |= changed
+                changed_at = time.monotonic()
+            elif pending and time.monotonic() - changed_at >= debounce:
+                self.update_all(sorted(pending))
+                pending = set()
+                state = self.snapshot()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='vszimg-watch', description='Export .vsz documents as Veusz-images.')
+    parser.add_argument('paths', nargs='+', help='.vsz files or directories')
+    parser.add_argument(
+        '-f', '--format', default='PNG',
+        choices=[backend.name for backend in backendregistry])
+    parser.add_argument('-d', '--outdir', help='directory of the images')
+    parser.add_argument(
+        '--once', action='store_true', help='export changed pages and exit')
+    parser.add_argument(
+        '--interval', type=float, default=1.0, help='polling interval (s)')
+    parser.add_argument(
+        '--debounce', type=float, default=2.0,
+        help='time for changes to settle before exporting (s)')
+    args = parser.parse_args(argv)
+    watcher = Watcher(args.paths, backend_by_name(args.format), args.outdir)
+    if args.once:
+        watcher.update_all(watcher.documents())
+        return 0
+    try:
+        watcher.watch(args.interval, args.debounce)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())